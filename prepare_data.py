@@ -62,6 +62,38 @@ def get_args():
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "--decompress",
+        dest="decompress",
+        default=False,
+        action="store_true",
+        help="Decompress .jsonl.zst files while downloading them (uses more disk, and downloads each "
+        "such file as a single stream rather than parallel range requests)",
+    )
+    parser.add_argument(
+        "--prefetch-decompressed",
+        dest="prefetch_decompressed",
+        default=False,
+        action="store_true",
+        help="Decompress .jsonl.zst files to .jsonl before tokenizing them. The .jsonl copies are kept next to the "
+        ".zst files (using the extra disk space) and reused by later runs. Has no effect on downloads already "
+        "decompressed with --decompress, so together with it only applies to customdataset",
+    )
+    parser.add_argument(
+        "--subprocess",
+        dest="in_process",
+        default=True,
+        action="store_false",
+        help="Tokenize by running tools/datasets/preprocess_data.py as a subprocess, rather than on a pool of "
+        "tokenizer workers in this process",
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        default=False,
+        action="store_true",
+        help="Tokenize jsonl(.zst) datasets straight from their urls, without saving the downloaded files",
+    )
     return parser.parse_args()
 
 
@@ -74,4 +106,8 @@ if __name__ == "__main__":
         vocab_file=args.vocab_file,
         merge_file=args.merge_file,
         force_redownload=args.force_redownload,
+        decompress=args.decompress,
+        prefetch_decompressed=args.prefetch_decompressed,
+        in_process=args.in_process,
+        stream=args.stream,
     )
@@ -0,0 +1,422 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import zstandard
+
+from tools.datasets import corpora
+from tools.datasets.corpora import (
+    DataDownloader,
+    _LazyUrls,
+    _TokenizerPool,
+    _jsonl_ranges,
+    _decompressed,
+    _optimal_workers,
+    fast_zstd_decompress,
+)
+
+
+TOKENIZER_ARGV = [
+    "--dataset-impl",
+    "mmap",
+    "--tokenizer-type",
+    "CharLevelTokenizer",
+    "--append-eod",
+]
+
+
+class DummyDataset(DataDownloader):
+    name = "dummy"
+    urls = ["http://example.com/data/a.jsonl", "http://example.com/data/b.jsonl"]
+
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def jsonl_lines(n, start=0):
+    return b"".join(b'{"text": "document %d"}\n' % i for i in range(start, start + n))
+
+
+def tokenizer_inputs(tmp_path):
+    """a plain and a zstd compressed jsonl file, with unicode, empty and multi-paragraph documents"""
+
+    def jsonl(docs):
+        return "".join(json.dumps({"text": doc}) + "\n" for doc in docs).encode("utf-8")
+
+    docs = [f"document {i} \u00e9\u4e2d " * (i % 7) for i in range(80)]
+    docs[5] = ["first paragraph", "second paragraph"]
+    return [
+        write_file(tmp_path / "a.jsonl", jsonl(docs[:40])),
+        write_file(
+            tmp_path / "b.jsonl.zst",
+            zstandard.ZstdCompressor().compress(jsonl(docs[40:])),
+        ),
+    ]
+
+
+class ByteTokenizer:
+    """utf-8 bytes as tokens, standing in for a real tokenizer"""
+
+    vocab_size = 257
+    eod = 256
+
+    def tokenize(self, text):
+        return list(text.encode("utf-8"))
+
+
+def tokenize_with_preprocess_data(monkeypatch, input_paths, output_prefix):
+    """tokenizes `input_paths` with preprocess_data.py's main(), returning the output .bin and .idx contents"""
+    preprocess_data = pytest.importorskip("tools.datasets.preprocess_data")
+    monkeypatch.setattr(
+        preprocess_data, "build_tokenizer", lambda args: ByteTokenizer()
+    )
+    preprocess_data.main(
+        ["--input", ",".join(input_paths), "--output-prefix", output_prefix]
+        + TOKENIZER_ARGV
+    )
+    return read_outputs(output_prefix)
+
+
+def read_outputs(output_prefix):
+    return [read_file(f"{output_prefix}_text_document.{ext}") for ext in ("bin", "idx")]
+
+
+def make_dataset(tmp_path, urls, **kwargs):
+    cls = type("RemoteDataset", (DataDownloader,), {"name": "remote", "urls": urls})
+    return cls(data_dir=str(tmp_path), num_workers=4, **kwargs)
+
+
+@pytest.fixture
+def http_server():
+    """
+    Serves `files` ({name: bytes}) over HTTP. `ranges` is "honour", "ignore" (advertised, but answered with the
+    whole file) or None (not advertised), and the first `failures` GETs are answered with a 503.
+    """
+    pytest.importorskip("aiohttp")
+    servers = []
+
+    def serve(files, ranges="honour", failures=0):
+        state = {"failures": failures, "requests": []}
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.respond(send_body=False)
+
+            def do_GET(self):
+                self.respond(send_body=True)
+
+            def respond(self, send_body):
+                name = self.path.lstrip("/")
+                byte_range = self.headers.get("Range")
+                state["requests"].append((self.command, name, byte_range))
+                if name not in files:
+                    self.send_error(404)
+                    return
+                if send_body and state["failures"] > 0:
+                    state["failures"] -= 1
+                    self.send_error(503)
+                    return
+                body, status = files[name], 200
+                if byte_range and ranges == "honour":
+                    start, end = map(int, byte_range[len("bytes=") :].split("-"))
+                    body, status = body[start : end + 1], 206
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                if ranges is not None:
+                    self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}", state
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.cpu
+def test_fast_zstd_decompress_single_frame(tmp_path):
+    data = jsonl_lines(1000)
+    path = write_file(
+        tmp_path / "data.jsonl.zst", zstandard.ZstdCompressor().compress(data)
+    )
+    assert fast_zstd_decompress(path) == str(tmp_path / "data.jsonl")
+    assert read_file(tmp_path / "data.jsonl") == data
+
+
+@pytest.mark.cpu
+def test_fast_zstd_decompress_multiple_frames(tmp_path):
+    cctx = zstandard.ZstdCompressor()
+    first, second = jsonl_lines(100), jsonl_lines(100, start=100)
+    path = write_file(
+        tmp_path / "data.jsonl.zst", cctx.compress(first) + cctx.compress(second)
+    )
+    assert read_file(fast_zstd_decompress(path)) == first + second
+
+
+@pytest.mark.cpu
+def test_fast_zstd_decompress_unknown_size(tmp_path):
+    data = jsonl_lines(1000)
+    compressed = zstandard.ZstdCompressor(write_content_size=False).compress(data)
+    assert zstandard.frame_content_size(compressed) == -1
+    path = write_file(tmp_path / "data.jsonl.zst", compressed)
+    assert read_file(fast_zstd_decompress(path)) == data
+
+
+@pytest.mark.cpu
+def test_fast_zstd_decompress_invalid_file(tmp_path):
+    path = write_file(tmp_path / "data.jsonl.zst", b"")
+    with pytest.raises(ValueError, match="data.jsonl.zst"):
+        fast_zstd_decompress(path)
+
+
+@pytest.mark.cpu
+def test_decompressed_reuses_up_to_date_copy(tmp_path):
+    cctx = zstandard.ZstdCompressor()
+    path = write_file(tmp_path / "data.jsonl.zst", cctx.compress(jsonl_lines(10)))
+    out_path = _decompressed(path)
+    assert read_file(out_path) == jsonl_lines(10)
+
+    # newer than the .zst: reused as is
+    write_file(out_path, b"stale")
+    assert read_file(_decompressed(path)) == b"stale"
+
+    # older than the .zst: decompressed again
+    stat = os.stat(path)
+    os.utime(out_path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+    assert read_file(_decompressed(path)) == jsonl_lines(10)
+    assert not os.path.exists(f"{out_path}.tmp")
+
+
+@pytest.mark.cpu
+def test_is_downloaded(tmp_path):
+    dataset = DummyDataset(data_dir=str(tmp_path), num_workers=1)
+    url = dataset.urls[0]
+    os.makedirs(tmp_path / "dummy")
+    path = write_file(dataset.local_path(url), b"0123456789")
+    manifest = {url: dataset._manifest_entry(url)}
+    stat = os.stat(path)
+    assert dataset._is_downloaded(manifest, url)
+    assert not dataset._is_downloaded(manifest, dataset.urls[1])
+
+    # same size and mtime: trusted without re-hashing
+    write_file(path, b"abcdefghij")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert dataset._is_downloaded(manifest, url)
+
+    # touched since it was recorded: re-hashed
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not dataset._is_downloaded(manifest, url)
+    write_file(path, b"0123456789")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert dataset._is_downloaded(manifest, url)
+
+    # size mismatch
+    write_file(path, b"01234")
+    assert not dataset._is_downloaded(manifest, url)
+
+
+@pytest.mark.cpu
+def test_record_existing_downloads(tmp_path):
+    urls = [f"http://example.com/{name}" for name in ("a.jsonl.zst", "b.bin", "c.bin")]
+    dataset = make_dataset(tmp_path, urls, decompress=True)
+    os.makedirs(tmp_path / "remote")
+    zst_path = write_file(
+        tmp_path / "remote" / "a.jsonl.zst",
+        zstandard.ZstdCompressor().compress(jsonl_lines(3)),
+    )
+    write_file(tmp_path / "remote" / "b.bin", b"b")
+
+    # only checking doesn't touch the directory
+    assert dataset.missing_urls() == urls
+    assert not dataset.exists()
+    assert not os.path.exists(dataset.manifest_path)
+    assert os.path.exists(zst_path)
+
+    # a directory without a manifest holds downloads from before it existed
+    dataset._record_existing_downloads()
+    assert dataset.missing_urls() == urls[2:]
+    assert read_file(dataset.local_path(urls[0])) == jsonl_lines(3)
+    assert not os.path.exists(zst_path)
+
+
+@pytest.mark.cpu
+def test_optimal_workers_env_override(monkeypatch):
+    monkeypatch.setenv("NEOX_TOKENIZE_WORKERS", "3")
+    assert _optimal_workers() == 3
+    assert _optimal_workers(num_docs=1) == 3
+    monkeypatch.setenv("NEOX_TOKENIZE_WORKERS", "0")
+    assert _optimal_workers() == 1
+
+
+@pytest.mark.cpu
+def test_optimal_workers_num_docs(monkeypatch):
+    monkeypatch.delenv("NEOX_TOKENIZE_WORKERS", raising=False)
+    workers = _optimal_workers()
+    assert 1 <= workers <= os.cpu_count()
+    assert _optimal_workers(num_docs=0) == 1
+    assert _optimal_workers(num_docs=corpora.DOCS_PER_WORKER) == 1
+    assert _optimal_workers(num_docs=2 * corpora.DOCS_PER_WORKER) == min(workers, 2)
+    assert _optimal_workers(num_docs=10**12) == workers
+
+
+@pytest.mark.cpu
+def test_lazy_urls():
+    expected = [f"http://example.com/{i}.jsonl" for i in range(5)]
+    calls = []
+
+    def make_urls():
+        calls.append(1)
+        return list(expected)
+
+    urls = _LazyUrls(make_urls)
+    assert not calls
+    assert len(urls) == 5
+    assert urls[0] == "http://example.com/0.jsonl"
+    assert urls[-1] == "http://example.com/4.jsonl"
+    assert urls[1:3] == ["http://example.com/1.jsonl", "http://example.com/2.jsonl"]
+    assert list(urls) == expected
+    # built once, on first use
+    assert len(calls) == 1
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("trailing_newline", [True, False])
+@pytest.mark.parametrize("range_size", [1, 7, 64, 1 << 20])
+def test_jsonl_ranges_cover_file(tmp_path, trailing_newline, range_size):
+    data = jsonl_lines(50)
+    if not trailing_newline:
+        data = data[:-1]
+    path = write_file(tmp_path / "data.jsonl", data)
+
+    ranges = list(_jsonl_ranges(path, range_size))
+    assert ranges[0][1] == 0
+    assert ranges[-1][2] == len(data)
+    for (_, _, end), (_, start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    # every range but the last ends on a line end, so no document is split
+    for _, start, end in ranges[:-1]:
+        assert data[end - 1 : end] == b"\n"
+    assert b"".join(data[start:end] for _, start, end in ranges) == data
+
+
+@pytest.mark.cpu
+def test_jsonl_ranges_empty_file(tmp_path):
+    path = write_file(tmp_path / "empty.jsonl", b"")
+    assert list(_jsonl_ranges(path, 16)) == []
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("ranges", ["honour", "ignore", None])
+def test_download(tmp_path, http_server, monkeypatch, ranges):
+    monkeypatch.setattr(corpora, "RANGE_CHUNK_SIZE", 1000)
+    monkeypatch.setattr(corpora, "WRITE_BUFFER_SIZE", 256)
+    data = os.urandom(10_500)
+    url, state = http_server({"data.bin": data}, ranges=ranges)
+    dataset = make_dataset(tmp_path, [f"{url}/data.bin"])
+    dataset.download()
+
+    assert read_file(dataset.local_path(f"{url}/data.bin")) == data
+    range_gets = [r for r in state["requests"] if r[0] == "GET" and r[2]]
+    if ranges == "honour":
+        # reassembled from concurrent range requests
+        assert len(range_gets) == 11
+    elif ranges == "ignore":
+        # falls back to a single request for the whole file
+        assert ("GET", "data.bin", None) in state["requests"]
+    else:
+        assert not range_gets
+
+
+@pytest.mark.cpu
+def test_download_retries_server_errors(tmp_path, http_server):
+    data = jsonl_lines(100)
+    url, state = http_server({"data.jsonl": data}, failures=1)
+    dataset = make_dataset(tmp_path, [f"{url}/data.jsonl"])
+    dataset.download()
+
+    assert read_file(dataset.local_path(f"{url}/data.jsonl")) == data
+    assert [r[0] for r in state["requests"]].count("GET") == 2
+
+
+@pytest.mark.cpu
+def test_download_records_manifest(tmp_path, http_server):
+    url, _ = http_server({"a.bin": b"a" * 100, "b.bin": b"b" * 100})
+    urls = [f"{url}/a.bin", f"{url}/b.bin"]
+    dataset = make_dataset(tmp_path, urls)
+    dataset.download()
+
+    assert set(dataset.load_manifest()) == set(urls)
+    assert dataset.exists()
+    write_file(dataset.local_path(urls[1]), b"c" * 99)
+    assert dataset.missing_urls() == urls[1:]
+
+
+@pytest.mark.cpu
+def test_download_missing_url_fails_up_front(tmp_path, http_server):
+    url, state = http_server({"a.bin": b"a" * 100})
+    dataset = make_dataset(tmp_path, [f"{url}/a.bin", f"{url}/missing.bin"])
+    with pytest.raises(Exception, match="missing.bin"):
+        dataset.download()
+
+    # the dead link is found by the HEAD requests, before anything is downloaded
+    assert all(command == "HEAD" for command, _, _ in state["requests"])
+    assert not os.path.exists(dataset.local_path(f"{url}/a.bin"))
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_tokenizer_pool_matches_preprocess_data(tmp_path, monkeypatch, num_workers):
+    input_paths = tokenizer_inputs(tmp_path)
+    expected = tokenize_with_preprocess_data(
+        monkeypatch, input_paths, str(tmp_path / "expected")
+    )
+    # many small byte ranges and batches, so their order matters
+    monkeypatch.setattr(corpora, "TOKENIZE_RANGE_SIZE", 100)
+    monkeypatch.setattr(corpora, "TOKENIZE_BATCH_SIZE", 3)
+
+    pool = _TokenizerPool(TOKENIZER_ARGV, num_workers)
+    try:
+        pool.submit(input_paths, str(tmp_path / "pool"))
+    finally:
+        pool.close()
+    assert read_outputs(str(tmp_path / "pool")) == expected
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_tokenizer_pool_streams_urls(tmp_path, http_server, monkeypatch, num_workers):
+    input_paths = tokenizer_inputs(tmp_path)
+    expected = tokenize_with_preprocess_data(
+        monkeypatch, input_paths, str(tmp_path / "expected")
+    )
+    monkeypatch.setattr(corpora, "TOKENIZE_BATCH_SIZE", 3)
+    names = [os.path.basename(path) for path in input_paths]
+    url, state = http_server({name: read_file(tmp_path / name) for name in names})
+
+    pool = _TokenizerPool(TOKENIZER_ARGV, num_workers)
+    try:
+        pool.submit_urls([f"{url}/{name}" for name in names], str(tmp_path / "pool"))
+    finally:
+        pool.close()
+    assert read_outputs(str(tmp_path / "pool")) == expected
+    # one plain GET per file, read as it arrives
+    assert state["requests"] == [("GET", name, None) for name in names]
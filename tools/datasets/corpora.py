@@ -15,11 +15,36 @@
 
 
 import os
+import sys
+import io
+import json
+import mmap
+import posixpath
+import itertools
+import shutil
+import hashlib
+import subprocess
+import asyncio
 from abc import ABC, abstractmethod
-from multiprocessing import cpu_count
+from collections import deque
+from collections.abc import Sequence
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+from multiprocessing import Pool
 from datasets import load_dataset
 from tqdm import tqdm
-import zipfile
+import numpy as np
+import zstandard
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
+
+try:
+    import psutil
+except ModuleNotFoundError:
+    psutil = None
 
 """
 This registry is for automatically downloading and extracting datasets.
@@ -31,8 +56,440 @@ When done, add it to the DATA_DOWNLOADERS dict. The function process_data runs t
 dataset.
 """
 
-GPT2_VOCAB_URL = "https://huggingface.co/datasets/RaviChandera/gpt2-vocab/raw/main/gpt2-vocab.json"
-GPT2_MERGE_URL = "https://huggingface.co/datasets/RaviChandera/gpt2-merges/raw/main/gpt2-merges.txt"
+GPT2_VOCAB_URL = (
+    "https://huggingface.co/datasets/RaviChandera/gpt2-vocab/raw/main/gpt2-vocab.json"
+)
+GPT2_MERGE_URL = (
+    "https://huggingface.co/datasets/RaviChandera/gpt2-merges/raw/main/gpt2-merges.txt"
+)
+
+# number of attempts per request before a download is given up on (5xx / dropped connections only)
+DOWNLOAD_RETRIES = 5
+# seconds to wait for more data from a server before the request is treated as failed
+DOWNLOAD_READ_TIMEOUT = 300
+# large files are fetched as concurrent HTTP range requests of this size
+RANGE_CHUNK_SIZE = 64 * 1024 * 1024
+# downloaded data is buffered up to this size before being written to disk
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+# zstd window size limit used when decompressing downloads (some shards are compressed with --long)
+ZSTD_MAX_WINDOW_SIZE = 2**31
+# zstd files whose recorded content size is at most this are decompressed in a single shot rather than streamed
+ZSTD_SINGLE_SHOT_MAX_SIZE = 1 << 30
+# read / write size for zstd streams - much larger than the 128KiB default, so data crosses between python and the
+# zstd C library in fewer, larger calls
+ZSTD_IO_SIZE = 4 * 1024 * 1024
+# datasets with a known number of documents get at most one preprocessing worker per this many documents
+DOCS_PER_WORKER = 50_000
+# documents are sent to tokenizer workers in batches of this size
+TOKENIZE_BATCH_SIZE = 1000
+# plain .jsonl inputs are handed to tokenizer workers as byte ranges of about this size, read by the workers themselves
+TOKENIZE_RANGE_SIZE = 16 * 1024 * 1024
+# how much of each input file the kernel is asked to read ahead when tokenization reaches it
+PREFETCH_SIZE = 1 << 30
+# url suffixes that can be tokenized straight from the HTTP response, without saving the file to disk first
+STREAMABLE_SUFFIXES = (".jsonl.zst", ".jsonl")
+
+
+class _RangeRequestIgnored(Exception):
+    """raised when a server answers a range request with the whole file"""
+
+
+def _pwrite_all(fd, buf, offset):
+    """writes all of `buf` to `fd` at `offset`, retrying on short writes"""
+    view = memoryview(buf)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+async def _run_in_thread(func, *args):
+    """runs the blocking `func` in the default executor (asyncio.to_thread needs python 3.9)"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _iter_buffered(resp):
+    """yields the body of an aiohttp response in buffers of at least `WRITE_BUFFER_SIZE` bytes"""
+    buf = bytearray()
+    async for chunk in resp.content.iter_chunked(1 << 20):
+        buf += chunk
+        if len(buf) >= WRITE_BUFFER_SIZE:
+            yield buf
+            buf = bytearray()
+    if buf:
+        yield buf
+
+
+def _decompress_file(src, dst):
+    """decompresses zstd file `src` to `dst`"""
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW_SIZE).copy_stream(
+            fin, fout, read_size=ZSTD_IO_SIZE, write_size=ZSTD_IO_SIZE
+        )
+
+
+def fast_zstd_decompress(path):
+    """
+    Decompresses the zstd file `path` next to itself (dropping the .zst suffix) and returns the output path.
+
+    If the frame header records the content size (and it is at most `ZSTD_SINGLE_SHOT_MAX_SIZE`), the output
+    buffer is allocated once at its final size and the whole file is decompressed in one call. Otherwise - or if
+    the file turns out to hold more than one frame - it is streamed.
+    """
+    out_path = path[: -len(".zst")]
+    # only ever leave a complete output at `out_path`
+    tmp_path = f"{out_path}.tmp"
+    with open(path, "rb") as f:
+        # the frame header is at most 18 bytes
+        try:
+            size = zstandard.frame_content_size(f.read(18))
+        except zstandard.ZstdError as e:
+            raise ValueError(
+                f"{path} is not a zstd file (it may be empty or truncated): {e}"
+            ) from e
+        if 0 <= size <= ZSTD_SINGLE_SHOT_MAX_SIZE:
+            f.seek(0)
+            data = f.read()
+            dctx = zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW_SIZE)
+            try:
+                out = dctx.decompress(
+                    data, max_output_size=size, allow_extra_data=False
+                )
+            except zstandard.ZstdError:
+                # trailing frames - fall through to streaming
+                out = None
+            if out is not None:
+                with open(tmp_path, "wb") as fout:
+                    fout.write(out)
+                os.replace(tmp_path, out_path)
+                return out_path
+    _decompress_file(path, tmp_path)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _decompressed(path):
+    """decompresses the zstd file `path` unless it already has an up-to-date decompressed copy, which is returned"""
+    out_path = path[: -len(".zst")]
+    try:
+        up_to_date = os.stat(out_path).st_mtime_ns >= os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        up_to_date = False
+    return out_path if up_to_date else fast_zstd_decompress(path)
+
+
+def _optimal_workers(num_docs=None):
+    """
+    Default number of preprocessing workers: one per physical core available to this process, since SMT siblings
+    add little to tokenization throughput, and fewer for small datasets where the extra workers only add IPC
+    overhead. Can be overridden with the NEOX_TOKENIZE_WORKERS environment variable.
+    """
+    if os.environ.get("NEOX_TOKENIZE_WORKERS"):
+        return max(1, int(os.environ["NEOX_TOKENIZE_WORKERS"]))
+    workers = os.cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        workers = min(workers, len(os.sched_getaffinity(0)))
+    if psutil is not None:
+        workers = min(workers, psutil.cpu_count(logical=False) or workers)
+    if num_docs is not None:
+        workers = min(workers, num_docs // DOCS_PER_WORKER)
+    return max(1, workers)
+
+
+def _batched(iterable, n):
+    """yields lists of up to `n` consecutive items of `iterable`"""
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+# preprocess_data Encoder of the current tokenizer worker process
+_worker_encoder = None
+
+
+def _init_tokenizer_worker(encoder):
+    global _worker_encoder
+    encoder.initializer()
+    _worker_encoder = encoder
+
+
+def _encode_batch(texts):
+    """tokenizes a batch of documents in a tokenizer worker"""
+    encoded = []
+    for text in texts:
+        ids, num_bytes = _worker_encoder.encode(text)
+        ids = {
+            key: [np.array(sentence, dtype=np.int32) for sentence in sentences]
+            for key, sentences in ids.items()
+        }
+        encoded.append((ids, num_bytes))
+    return encoded
+
+
+def _prefetch(path):
+    """asks the kernel to start reading the beginning of `path` into the page cache before it is tokenized"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = min(os.fstat(fd).st_size, PREFETCH_SIZE)
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _drop_from_page_cache(path):
+    """writes back a finished output file and tells the kernel it won't be read again soon, so it can be evicted"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # DONTNEED skips dirty pages, so they have to be on disk first
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _jsonl_ranges(path, range_size):
+    """splits the jsonl file at `path` into (path, start, end) byte ranges of about `range_size`, ending on line ends"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b"\n", min(start + range_size, size) - 1)
+            end = size if end == -1 else end + 1
+            yield path, start, end
+            start = end
+
+
+def _jsonl_text(line):
+    """document text of one json line, following lm_dataformat's jsonl handling"""
+    ob = json.loads(line)
+    if isinstance(ob, str):
+        return ob
+    text = ob["text"]
+    if isinstance(text, list):
+        text = "\n\n".join(text)
+    return text
+
+
+def _encode_jsonl_range(byte_range):
+    """tokenizes the documents in a (path, start, end) byte range of a jsonl file in a tokenizer worker"""
+    path, start, end = byte_range
+    # workers map the file themselves, so only the offsets go over IPC
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = mm[start:end].split(b"\n")
+    return _encode_jsonl_lines(lines)
+
+
+def _encode_jsonl_lines(lines):
+    """tokenizes the documents in a batch of raw json lines in a tokenizer worker"""
+    texts = [_jsonl_text(line) for line in lines if line.strip()]
+    return _encode_batch([text for text in texts if text])
+
+
+def _stream_jsonl_lines(url):
+    """yields the raw lines of the (optionally zstd compressed) jsonl file at `url`, decompressing on the fly"""
+    # a stalled server fails the run rather than hanging it (the stream can't resume, so there are no retries)
+    with urlopen(url, timeout=DOWNLOAD_READ_TIMEOUT) as resp:
+        stream = resp
+        if _url_filename(url).endswith(".zst"):
+            stream = io.BufferedReader(
+                zstandard.ZstdDecompressor(
+                    max_window_size=ZSTD_MAX_WINDOW_SIZE
+                ).stream_reader(resp, read_size=ZSTD_IO_SIZE, read_across_frames=True),
+                WRITE_BUFFER_SIZE,
+            )
+        yield from stream
+
+
+class _TokenizerPool:
+    """
+    Long-lived pool of tokenizer worker processes. Each worker builds its tokenizer once, when the pool starts, and
+    the pool is reused by later tokenize() calls with the same tokenizer settings. Documents are sent to the workers
+    in batches of `TOKENIZE_BATCH_SIZE` to amortize IPC. Plain .jsonl files are instead split into byte ranges that
+    the workers read directly, so a single large file is spread over all workers.
+    """
+
+    _current = None
+
+    @classmethod
+    def get(cls, tokenizer_argv, num_workers):
+        """returns a pool for the given preprocess_data tokenizer arguments, reusing the current one if it matches"""
+        key = (tuple(tokenizer_argv), num_workers)
+        if cls._current is None or cls._current.key != key:
+            if cls._current is not None:
+                cls._current.close()
+            cls._current = cls(tokenizer_argv, num_workers)
+        return cls._current
+
+    def __init__(self, tokenizer_argv, num_workers):
+        from tools.datasets.preprocess_data import Encoder, get_args
+
+        self.key = (tuple(tokenizer_argv), num_workers)
+        # preprocess_data requires input / output arguments, but the pool only needs the tokenizer settings
+        self.args = get_args(
+            ["--input", "", "--output-prefix", ""] + list(tokenizer_argv)
+        )
+        self.num_workers = num_workers
+        encoder = Encoder(self.args)
+        # the main process needs the tokenizer too, for the vocab size (and to do the work if there is one worker)
+        _init_tokenizer_worker(encoder)
+        self.vocab_size = Encoder.tokenizer.vocab_size
+        self._pool = None
+        if num_workers > 1:
+            self._pool = Pool(
+                num_workers, initializer=_init_tokenizer_worker, initargs=(encoder,)
+            )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def _encode(self, tasks):
+        """runs (function, argument) `tasks` in order, keeping at most two tasks per worker in flight"""
+        if self._pool is None:
+            for func, arg in tasks:
+                yield from func(arg)
+            return
+
+        pending = deque()
+        for func, arg in tasks:
+            pending.append(self._pool.apply_async(func, (arg,)))
+            if len(pending) >= 2 * self.num_workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+    @staticmethod
+    def _tasks(input_paths):
+        """tokenization tasks covering `input_paths`, in document order"""
+        import lm_dataformat as lmd
+
+        for path in input_paths:
+            # tasks are generated a few ahead of the workers, so this starts the read before they reach the file
+            _prefetch(path)
+            if path.endswith(".jsonl"):
+                for byte_range in _jsonl_ranges(path, TOKENIZE_RANGE_SIZE):
+                    yield _encode_jsonl_range, byte_range
+            else:
+                docs = (doc for doc in lmd.Reader(path).stream_data() if doc)
+                for batch in _batched(docs, TOKENIZE_BATCH_SIZE):
+                    yield _encode_batch, batch
+
+    def submit(self, input_paths, output_prefix, num_docs=None):
+        """tokenizes the documents in `input_paths` into the indexed datasets `{output_prefix}_{key}_document`"""
+        self._write(self._tasks(input_paths), output_prefix, num_docs)
+
+    def submit_urls(self, urls, output_prefix, num_docs=None):
+        """
+        Tokenizes the jsonl(.zst) files at `urls` straight from the HTTP responses, without writing them to disk,
+        into the indexed datasets `{output_prefix}_{key}_document`.
+        """
+        tasks = (
+            (_encode_jsonl_lines, lines)
+            for url in urls
+            for lines in _batched(_stream_jsonl_lines(url), TOKENIZE_BATCH_SIZE)
+        )
+        self._write(tasks, output_prefix, num_docs)
+
+    def _write(self, tasks, output_prefix, num_docs=None):
+        from megatron.data import indexed_dataset
+
+        builders = {
+            key: indexed_dataset.make_builder(
+                f"{output_prefix}_{key}_document.bin",
+                impl=self.args.dataset_impl,
+                vocab_size=self.vocab_size,
+            )
+            for key in self.args.jsonl_keys
+        }
+        with tqdm(total=num_docs, unit="docs") as pbar:
+            for doc, _ in self._encode(tasks):
+                for key, sentences in doc.items():
+                    for sentence in sentences:
+                        builders[key].add_item(
+                            sentence.astype(builders[key].dtype, copy=False)
+                        )
+                    builders[key].end_document()
+                pbar.update()
+        for key, builder in builders.items():
+            builder.finalize(f"{output_prefix}_{key}_document.idx")
+            _drop_from_page_cache(f"{output_prefix}_{key}_document.bin")
+            _drop_from_page_cache(f"{output_prefix}_{key}_document.idx")
+
+
+def _allocate(path, size):
+    """creates (or truncates) `path` as a sparse file of `size` bytes"""
+    # not posix_fallocate: where the filesystem doesn't support it, glibc emulates it by writing every block, which
+    # would write the whole file once more before downloading it
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _url_filename(url):
+    """file name at the end of `url`'s path (ignoring any query string)"""
+    return posixpath.basename(urlsplit(url).path)
+
+
+def _sha256(path):
+    """sha256 hex digest of the file at `path`"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(WRITE_BUFFER_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _compress_text_files(args):
+    """writes the text files in `file_paths` to the zstd compressed jsonl `out_path`, one document per file"""
+    file_paths, out_path, threads = args
+    cctx = zstandard.ZstdCompressor(level=3, threads=threads)
+    with open(out_path, "wb") as f, cctx.stream_writer(
+        f, write_size=ZSTD_IO_SIZE
+    ) as writer:
+        # hand documents to the compressor in large chunks rather than one small write per file
+        buf = bytearray()
+        for file_path in file_paths:
+            with open(file_path, "r", encoding="utf-8") as fin:
+                buf += json.dumps({"text": fin.read()}).encode("utf-8") + b"\n"
+            if len(buf) >= ZSTD_IO_SIZE:
+                writer.write(buf)
+                buf = bytearray()
+        writer.write(buf)
+    return out_path
+
+
+class _LazyUrls(Sequence):
+    """Read-only list for long generated url lists, which are only built (once) on first use"""
+
+    def __init__(self, make_urls):
+        self._make_urls = make_urls
+        self._urls = None
+
+    def _get_urls(self):
+        if self._urls is None:
+            self._urls = self._make_urls()
+        return self._urls
+
+    def __getitem__(self, index):
+        return self._get_urls()[index]
+
+    def __len__(self):
+        return len(self._get_urls())
+
+    def __repr__(self):
+        return repr(self._get_urls())
 
 
 class DataDownloader(ABC):
@@ -47,6 +504,10 @@ class DataDownloader(ABC):
         force_redownload=None,
         num_workers=None,
         dataset_name=None,
+        decompress=None,
+        prefetch_decompressed=None,
+        in_process=None,
+        stream=None,
     ):
         if tokenizer_type is None:
             tokenizer_type = "GPT2BPETokenizer"
@@ -66,7 +527,15 @@ class DataDownloader(ABC):
             else:
                 assert vocab_file is not None, "No vocab file provided"
         if num_workers is None:
-            num_workers = cpu_count()
+            num_workers = _optimal_workers(self.num_docs)
+        if decompress is None:
+            decompress = False
+        if prefetch_decompressed is None:
+            prefetch_decompressed = False
+        if in_process is None:
+            in_process = True
+        if stream is None:
+            stream = False
         self._tokenizer_type = tokenizer_type
         self._merge_file = merge_file
         self._vocab_file = vocab_file
@@ -74,6 +543,12 @@ class DataDownloader(ABC):
         self._force_redownload = force_redownload
         self._num_workers = num_workers
         self.dataset_name = dataset_name
+        self._decompress = decompress
+        self._prefetch_decompressed = prefetch_decompressed
+        self._in_process = in_process
+        self._stream = stream
+        # url -> local file path, computed once since download() and tokenize() look these up for every url
+        self._local_paths = {url: self._make_local_path(url) for url in self.urls or []}
 
     @property
     def base_dir(self):
@@ -122,84 +597,502 @@ class DataDownloader(ABC):
         """Use ftfy (https://github.com/LuminosoInsight/python-ftfy) to fix text encodings"""
         return False
 
-    def exists(self):
-        """Checks if the dataset is present"""
-        return os.path.isdir(f"{self.base_dir}/{self.name}")
+    @property
+    def decompress(self):
+        """
+        Decompress .jsonl.zst files while downloading them, so tokenization reads plain .jsonl. The response is
+        decompressed as one stream, so these files are not fetched as parallel range requests.
+        """
+        return self._decompress
+
+    @property
+    def prefetch_decompressed(self):
+        """
+        Decompress any .jsonl.zst inputs to .jsonl (kept next to them, and reused while newer than the .zst) before
+        tokenizing them
+        """
+        return self._prefetch_decompressed
 
-    def download(self):
-        """downloads dataset"""
+    @property
+    def in_process(self):
+        """Tokenize on a long-lived pool of tokenizer workers rather than by running preprocess_data.py as a subprocess"""
+        return self._in_process
+
+    @property
+    def stream(self):
+        """Tokenize jsonl(.zst) datasets straight from their urls, without saving the downloaded files"""
+        return self._stream
+
+    def _download_path(self, url):
+        """Path to which an external downloader saves `url`, before any decompression"""
+        return os.path.join(self.base_dir, self.name, _url_filename(url))
+
+    def _make_local_path(self, url):
+        path = self._download_path(url)
+        if self.decompress and path.endswith(".jsonl.zst"):
+            path = path[: -len(".zst")]
+        return path
+
+    def local_path(self, url):
+        """Path to which `url` is downloaded"""
+        if url in self._local_paths:
+            return self._local_paths[url]
+        return self._make_local_path(url)
+
+    @property
+    def manifest_path(self):
+        """Sidecar file recording the size and sha256 of every completed download"""
+        return os.path.join(self.base_dir, self.name, ".manifest.json")
+
+    def load_manifest(self):
+        """Returns the download manifest ({url: file record}), or an empty dict if there is none yet"""
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_manifest(self, manifest):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _manifest_entry(self, url):
+        path = self.local_path(url)
+        stat = os.stat(path)
+        return {
+            "file": os.path.basename(path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": _sha256(path),
+        }
+
+    def _is_downloaded(self, manifest, url):
+        """Checks the local file for `url` against its manifest record"""
+        entry = manifest.get(url)
+        path = self.local_path(url)
+        if (
+            entry is None
+            or entry["file"] != os.path.basename(path)
+            or not os.path.isfile(path)
+        ):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != entry["size"]:
+            return False
+        # only re-hash files that have been touched since they were recorded
+        return stat.st_mtime_ns == entry["mtime_ns"] or _sha256(path) == entry["sha256"]
+
+    def _record_existing_downloads(self, skip=()):
+        """
+        One-time migration of a dataset directory downloaded before the manifest was introduced: records its files
+        (other than those of the urls in `skip`, which are about to be downloaded again) so they are hashed once
+        rather than fetched again. Old .jsonl.zst downloads are decompressed locally if `decompress` is set.
+
+        download() always writes a manifest before fetching anything, so a directory without one can only hold
+        complete downloads from before the manifest existed (and not, say, preallocated files of an aborted run).
+        """
+        if os.path.exists(self.manifest_path):
+            return
         os.makedirs(os.path.join(self.base_dir, self.name), exist_ok=True)
+        skip = set(skip)
+        manifest = {}
         for url in self.urls:
+            if url in skip:
+                continue
+            if os.path.isfile(self.local_path(url)):
+                print(f"Recording existing download {self.local_path(url)}")
+                manifest[url] = self._manifest_entry(url)
+                self._save_manifest(manifest)
+            elif os.path.isfile(self._download_path(url)):
+                print(f"Decompressing existing download {self._download_path(url)}")
+                self._finish_download(manifest, url)
+        self._save_manifest(manifest)
+
+    def missing_urls(self):
+        """URLs that have no verified local copy"""
+        manifest = self.load_manifest()
+        return [url for url in self.urls if not self._is_downloaded(manifest, url)]
+
+    def exists(self):
+        """Checks if the dataset is present"""
+        return not self.missing_urls()
+
+    def download(self, urls=None):
+        """downloads dataset (or only `urls`, if given) and records each completed file in the manifest"""
+        if urls is None:
+            urls = self.urls
+        self._record_existing_downloads(skip=urls)
+        if aiohttp is not None:
+            asyncio.run(self._download_all(urls))
+        elif shutil.which("aria2c") is not None:
+            print("aiohttp not found - downloading with aria2c")
+            self._download_aria2(urls)
+        else:
+            print(
+                "aiohttp and aria2c not found - falling back to sequential wget downloads"
+            )
+            self._download_wget(urls)
+
+    def _download_aria2(self, urls):
+        """downloads `urls` with a single aria2c call (parallel across urls and segmented within each url)"""
+        download_dir = os.path.join(self.base_dir, self.name)
+        input_file = os.path.join(download_dir, ".aria2-urls.txt")
+        with open(input_file, "w") as f:
+            for url in urls:
+                f.write(f"{url}\n  dir={download_dir}\n  out={_url_filename(url)}\n")
+        cmd = [
+            "aria2c",
+            "-i",
+            input_file,
+            "-j",
+            str(self.num_workers),
+            "-x",
+            "16",
+            "-s",
+            "16",
+            "--allow-overwrite=true",
+            "--auto-file-renaming=false",
+        ]
+        try:
+            subprocess.run(cmd, check=True)
+        except subprocess.CalledProcessError as e:
+            raise Exception(
+                f"Download error: Cannot download files from {input_file}: server may be down"
+            ) from e
+        finally:
+            os.remove(input_file)
+
+        manifest = self.load_manifest()
+        for url in urls:
+            self._finish_download(manifest, url)
+
+    def _download_wget(self, urls):
+        """downloads `urls` one at a time with wget"""
+        manifest = self.load_manifest()
+        for url in urls:
+            path = self._download_path(url)
+            try:
+                subprocess.run(["wget", url, "-O", path], check=True)
+            except subprocess.CalledProcessError as e:
+                raise Exception(
+                    f"Download error: Cannot download file at URL {url}: server may be down"
+                ) from e
+            self._finish_download(manifest, url)
+
+    def _finish_download(self, manifest, url):
+        """decompresses a file fetched by an external downloader if needed, then records it in the manifest"""
+        path = self._download_path(url)
+        if self.local_path(url) != path:
+            fast_zstd_decompress(path)
+            os.remove(path)
+        manifest[url] = self._manifest_entry(url)
+        self._save_manifest(manifest)
+
+    async def _download_all(self, urls):
+        """downloads all urls concurrently, with at most `num_workers` requests in flight"""
+        manifest = self.load_manifest()
+        sem = asyncio.Semaphore(self.num_workers)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=DOWNLOAD_READ_TIMEOUT)
+
+        async def fetch_and_record(session, url, ranged_size):
+            await self._fetch(session, url, self.local_path(url), sem, ranged_size)
+            # hash off the event loop, but only touch the manifest from it
+            manifest[url] = await _run_in_thread(self._manifest_entry, url)
+            self._save_manifest(manifest)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            # check every url (and learn its size) before downloading anything, so a dead link fails the run up front
+            heads = await asyncio.gather(
+                *[self._head(session, url, sem) for url in urls]
+            )
+
+            # files fetched as range requests are created at full size up front, so the ranges can be written at
+            # their offsets. Truncating an old copy can take a while, so this happens off the event loop
+            ranged_sizes = [
+                size
+                if size
+                and accepts_ranges
+                and self.local_path(url) == self._download_path(url)
+                else None
+                for url, (size, accepts_ranges) in zip(urls, heads)
+            ]
+            await asyncio.gather(
+                *[
+                    _run_in_thread(_allocate, self.local_path(url), size)
+                    for url, size in zip(urls, ranged_sizes)
+                    if size
+                ]
+            )
+
+            await asyncio.gather(
+                *[
+                    fetch_and_record(session, url, ranged_size)
+                    for url, ranged_size in zip(urls, ranged_sizes)
+                ]
+            )
+
+    async def _fetch(self, session, url, path, sem, ranged_size=None):
+        """
+        Downloads a single url to `path`. If `path` is the decompressed version of a .jsonl.zst url, the response is
+        decompressed as it arrives. Otherwise, if `ranged_size` is given (`path` must already be allocated at that
+        size), the file is split into `RANGE_CHUNK_SIZE` ranges which are fetched concurrently and written in place.
+        """
+        if path != self._download_path(url):
+
+            async def consume(resp):
+                with open(path, "wb") as f:
+                    writer = zstandard.ZstdDecompressor(
+                        max_window_size=ZSTD_MAX_WINDOW_SIZE
+                    ).stream_writer(f, write_size=ZSTD_IO_SIZE)
+                    async for buf in _iter_buffered(resp):
+                        await _run_in_thread(writer.write, buf)
+                    writer.flush()
+
+            await self._get(session, url, sem, consume)
+            return
+
+        if ranged_size:
+            fd = os.open(path, os.O_WRONLY)
+            byte_ranges = [
+                (start, min(start + RANGE_CHUNK_SIZE, ranged_size) - 1)
+                for start in range(0, ranged_size, RANGE_CHUNK_SIZE)
+            ]
+        else:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            byte_ranges = [None]
+        tasks = [
+            asyncio.ensure_future(self._fetch_range(session, url, fd, byte_range, sem))
+            for byte_range in byte_ranges
+        ]
+        try:
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # a failed range leaves the others running - stop them before `fd` is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except _RangeRequestIgnored:
+            print(f"{url}: server ignored range request - downloading it in one piece")
+            await _run_in_thread(os.ftruncate, fd, 0)
+            await self._fetch_range(session, url, fd, None, sem)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    async def _head(session, url, sem):
+        """
+        returns (content length, whether byte ranges are supported) for `url`, or (None, False) if the server won't
+        say. Raises if the url does not exist.
+        """
+        try:
+            async with sem, session.head(url, allow_redirects=True) as resp:
+                resp.raise_for_status()
+                return resp.content_length, resp.headers.get("Accept-Ranges") == "bytes"
+        except aiohttp.ClientResponseError as e:
+            if e.status in (404, 410):
+                raise Exception(
+                    f"Download error: Cannot download file at URL {url}: {e}"
+                )
+            # some servers reject HEAD requests - just do a plain GET
+            return None, False
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # transient errors are retried by the GET
+            return None, False
+
+    @classmethod
+    async def _fetch_range(cls, session, url, fd, byte_range, sem):
+        """
+        Fetches `byte_range` (inclusive (start, end) tuple, or None for the whole file) of `url` and writes it
+        to `fd` at the matching offset.
+        """
+        headers = {}
+        offset = 0
+        if byte_range is not None:
+            headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+            offset = byte_range[0]
+
+        async def consume(resp):
+            if byte_range is not None and resp.status != 206:
+                raise _RangeRequestIgnored(url)
+            # keep the (blocking) writes off the event loop
+            pos = offset
+            async for buf in _iter_buffered(resp):
+                await _run_in_thread(_pwrite_all, fd, buf, pos)
+                pos += len(buf)
+
+        await cls._get(session, url, sem, consume, headers)
+
+    @staticmethod
+    async def _get(session, url, sem, consume, headers=None):
+        """
+        GETs `url` and hands the response to the coroutine function `consume`. Server errors and dropped
+        connections are retried with exponential backoff, in which case `consume` is called again from scratch.
+        """
+        for attempt in range(DOWNLOAD_RETRIES):
             try:
-                os_cmd = f"wget {url} -O {os.path.join(self.base_dir, self.name, os.path.basename(url))}"
-                if os.system(os_cmd) != 0:
+                async with sem, session.get(url, headers=headers or {}) as resp:
+                    resp.raise_for_status()
+                    await consume(resp)
+                return
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500 or attempt == DOWNLOAD_RETRIES - 1:
+                    raise Exception(
+                        f"Download error: Cannot download file at URL {url}: {e}"
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == DOWNLOAD_RETRIES - 1:
                     raise Exception(
-                        f"Cannot download file at URL {url}: server may be down"
+                        f"Download error: Cannot download file at URL {url}: {e}"
                     )
-            except Exception as e:
-                raise Exception(f"Download error: {e}")
+            await asyncio.sleep(2**attempt)
 
-    def tokenize(self, jsonl_filepath = None):
+    def tokenize(self, jsonl_filepath=None):
 
         """tokenizes dataset"""
         parent_folder = os.path.join(self.base_dir, self.name)
-        jsonl_filepath = jsonl_filepath if jsonl_filepath is not None else ",".join(
-            [os.path.join(parent_folder, os.path.basename(url)) for url in self.urls]
-        )  
-
-        cmd = f"python tools/datasets/preprocess_data.py \
-            --input {jsonl_filepath} \
-            --output-prefix {parent_folder}/{self.name} \
-            --vocab {self.vocab_file} \
-            --dataset-impl mmap \
-            --tokenizer-type {self.tokenizer_type} \
-            --merge-file {self.merge_file} \
-            --append-eod \
-            --workers {self.num_workers} "
-
-        if self.num_docs is not None:
-            cmd += f"--num-docs {self.num_docs} "
+        jsonl_filepath = (
+            jsonl_filepath
+            if jsonl_filepath is not None
+            else ",".join(self._local_paths.values())
+        )
+        if self.prefetch_decompressed:
+            jsonl_filepath = ",".join(
+                _decompressed(path) if path.endswith(".jsonl.zst") else path
+                for path in jsonl_filepath.split(",")
+            )
+
+        output_prefix = f"{parent_folder}/{self.name}"
+        if not self.in_process:
+            argv = self._preprocess_argv(
+                jsonl_filepath, output_prefix, self.num_workers, self.num_docs
+            )
+            # one OpenMP thread per tokenizer process - preprocess_data already runs one process per worker
+            env = dict(os.environ)
+            env.setdefault("OMP_NUM_THREADS", "1")
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.join(os.path.dirname(__file__), "preprocess_data.py"),
+                ]
+                + argv,
+                check=True,
+                env=env,
+            )
+            return
+
+        _TokenizerPool.get(self._tokenizer_argv(), self.num_workers).submit(
+            jsonl_filepath.split(","), output_prefix, self.num_docs
+        )
 
-        if self.ftfy:
-            cmd += f"--ftfy "
+    def tokenize_stream(self):
+        """tokenizes the dataset straight from its urls (which must all be jsonl(.zst) files)"""
+        parent_folder = os.path.join(self.base_dir, self.name)
+        os.makedirs(parent_folder, exist_ok=True)
+        _TokenizerPool.get(self._tokenizer_argv(), self.num_workers).submit_urls(
+            self.urls, f"{parent_folder}/{self.name}", self.num_docs
+        )
 
-        os.system(cmd)
+    def _tokenizer_argv(self):
+        """preprocess_data.py arguments controlling how documents are tokenized"""
+        argv = [
+            "--dataset-impl",
+            "mmap",
+            "--tokenizer-type",
+            self.tokenizer_type,
+            "--append-eod",
+        ]
+        if self.vocab_file is not None:
+            argv += ["--vocab-file", self.vocab_file]
+        if self.merge_file is not None:
+            argv += ["--merge-file", self.merge_file]
+        if self.ftfy:
+            argv += ["--ftfy"]
+        return argv
+
+    def _preprocess_argv(self, input_path, output_prefix, workers, num_docs=None):
+        """command line arguments for tools/datasets/preprocess_data.py"""
+        argv = [
+            "--input",
+            input_path,
+            "--output-prefix",
+            output_prefix,
+            "--workers",
+            str(workers),
+        ] + self._tokenizer_argv()
+        if num_docs is not None:
+            argv += ["--num-docs", str(num_docs)]
+        return argv
 
-        
     def customdataset_from_text(self):
-
+        """
+        Packs every .txt file in `base_dir` into a single zstd compressed jsonl file (one document per text file)
+        and returns its path.
+        """
         os.makedirs(os.path.join(self.base_dir, self.name), exist_ok=True)
         download_dir = os.path.join(self.base_dir, self.name)
 
-        zip_file_path = "/content/gpt-neox/data/text_file.zip"
-        txt_files = [f for f in os.listdir(self.base_dir) if f.endswith('.txt') and f != "gpt2-merges.txt"]
+        jsonl_zst_path = os.path.join(download_dir, f"{self.name}.jsonl.zst")
+        txt_files = [
+            f
+            for f in os.listdir(self.base_dir)
+            if f.endswith(".txt") and f != "gpt2-merges.txt"
+        ]
 
         # Assert that there are .txt files
         assert txt_files, f"No textfile found at {self.base_dir}."
-        
-        with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-
-            for txt_file in txt_files:
-                file_path = os.path.join(self.base_dir, txt_file)
-                zipf.write(file_path, os.path.basename(file_path))
-                
 
+        file_paths = [os.path.join(self.base_dir, f) for f in txt_files]
+        num_shards = min(self.num_workers, len(file_paths))
+        if num_shards <= 1:
+            # threads=-1 lets zstd compress on all cores
+            _compress_text_files((file_paths, jsonl_zst_path, -1))
+            return jsonl_zst_path
+
+        # compress contiguous slices of the file list in parallel (single threaded zstd in each worker), so the
+        # concatenated output keeps the original file order
+        bounds = [len(file_paths) * i // num_shards for i in range(num_shards + 1)]
+        shards = [
+            (file_paths[bounds[i] : bounds[i + 1]], f"{jsonl_zst_path}.part{i}", 0)
+            for i in range(num_shards)
+        ]
+        with Pool(num_shards) as p:
+            part_paths = p.map(_compress_text_files, shards, chunksize=1)
+
+        # zstd frames can be concatenated, so the parts just need to be appended to each other
+        with open(jsonl_zst_path, "wb") as fout:
+            for part_path in part_paths:
+                with open(part_path, "rb") as fin:
+                    shutil.copyfileobj(fin, fout, WRITE_BUFFER_SIZE)
+                os.remove(part_path)
+
+        return jsonl_zst_path
 
     def prepare(self):
-        
+
         if self.name == "customdataset":
-            self.customdataset_from_text()
-            zip_file_path = os.path.join(os.path.join(self.base_dir, self.name), f"{self.name}.zip")
-            self.tokenize(zip_file_path)
+            self.tokenize(self.customdataset_from_text())
+
+        elif (
+            self.stream
+            and self.in_process
+            and all(
+                _url_filename(url).endswith(STREAMABLE_SUFFIXES) for url in self.urls
+            )
+        ):
+            self.tokenize_stream()
 
         elif self._force_redownload:
             self.download()
             self.tokenize()
         else:
-            if not self.exists():
-                self.download()
+            self._record_existing_downloads()
+            missing_urls = self.missing_urls()
+            if missing_urls:
+                self.download(missing_urls)
             self.tokenize()
-        
 
 
 class Enron(DataDownloader):
@@ -215,9 +1108,12 @@ class PileSubset(DataDownloader):
 
 class Pile(DataDownloader):
     name = "pile"
-    urls = [
-        f"https://the-eye.eu/public/AI/pile/train/{i:02}.jsonl.zst" for i in range(30)
-    ]
+    urls = _LazyUrls(
+        lambda: [
+            f"https://the-eye.eu/public/AI/pile/train/{i:02}.jsonl.zst"
+            for i in range(30)
+        ]
+    )
 
 
 class Github(DataDownloader):
@@ -307,34 +1203,66 @@ class YoutubeSubtitles(DataDownloader):
 
 class C4(DataDownloader):
     name = "c4"
-    urls = [
-        f"https://the-eye.eu/eleuther_staging/c4/en/c4-train.{i:05}-of-01024.json.gz"
-        for i in range(1024)
-    ]
+    urls = _LazyUrls(
+        lambda: [
+            f"https://the-eye.eu/eleuther_staging/c4/en/c4-train.{i:05}-of-01024.json.gz"
+            for i in range(1024)
+        ]
+    )
 
 
 class C4OpenWebText(DataDownloader):
     name = "c4_openwebtext"
-    urls = [
-        f"https://the-eye.eu/eleuther_staging/c4/realnewslike/c4-train.{i:05}-of-00512.json.gz"
-        for i in range(512)
-    ]
+    urls = _LazyUrls(
+        lambda: [
+            f"https://the-eye.eu/eleuther_staging/c4/realnewslike/c4-train.{i:05}-of-00512.json.gz"
+            for i in range(512)
+        ]
+    )
 
 
 class CustomDataset(DataDownloader):
     name = "customdataset"
-    urls = None 
+    urls = None
 
 
+def _cached_download(url):
+    """
+    Downloads `url` into the user-wide cache ($NEOX_CACHE, default ~/.cache/gpt-neox) unless it is already there,
+    and returns the cached file's path.
+    """
+    cache_dir = os.path.join(
+        os.environ.get("NEOX_CACHE", os.path.expanduser("~/.cache/gpt-neox")), "gpt2"
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{url_hash}-{_url_filename(url)}")
+    if not os.path.isfile(cache_path):
+        # download to a temporary file so an interrupted download is never mistaken for a cached one
+        tmp_path = f"{cache_path}.tmp"
+        subprocess.run(["wget", url, "-O", tmp_path], check=True)
+        os.replace(tmp_path, cache_path)
+    return cache_path
+
 
 def maybe_download_gpt2_tokenizer_data(tokenizer_type, data_dir):
     if tokenizer_type is None or tokenizer_type == "GPT2BPETokenizer":
-        GPT2_VOCAB_FP = f"{data_dir}//gpt2-vocab.json"
-        GPT2_MERGE_FP = f"{data_dir}/gpt2-merges.txt"
-        if not os.path.isfile(GPT2_VOCAB_FP):
-            os.system(f"wget {GPT2_VOCAB_URL} -O {GPT2_VOCAB_FP}")
-        if not os.path.isfile(GPT2_MERGE_FP):
-            os.system(f"wget {GPT2_MERGE_URL} -O {GPT2_MERGE_FP}")
+        GPT2_VOCAB_FP = os.path.join(data_dir, "gpt2-vocab.json")
+        GPT2_MERGE_FP = os.path.join(data_dir, "gpt2-merges.txt")
+        for url, path in (
+            (GPT2_VOCAB_URL, GPT2_VOCAB_FP),
+            (GPT2_MERGE_URL, GPT2_MERGE_FP),
+        ):
+            if os.path.isfile(path):
+                continue
+            cache_path = _cached_download(url)
+            if os.path.lexists(path):
+                # dangling symlink to a cache file that has since been removed
+                os.remove(path)
+            try:
+                os.symlink(os.path.abspath(cache_path), path)
+            except OSError:
+                shutil.copyfile(cache_path, path)
 
 
 DATA_DOWNLOADERS = {
@@ -357,7 +1285,7 @@ DATA_DOWNLOADERS = {
     "youtube_subtitles": YoutubeSubtitles,
     "c4": C4,
     "c4_openwebtext": C4OpenWebText,
-    "customdataset":CustomDataset,
+    "customdataset": CustomDataset,
 }
 
 
@@ -369,6 +1297,10 @@ def prepare_dataset(
     merge_file: str = None,
     force_redownload: bool = None,
     num_workers: int = None,
+    decompress: bool = None,
+    prefetch_decompressed: bool = None,
+    in_process: bool = None,
+    stream: bool = None,
 ):
     """
     Downloads + tokenizes a dataset in the registry (dataset_name) and saves output .npy files to data_dir.
@@ -377,7 +1309,7 @@ def prepare_dataset(
         data_dir = os.environ.get("DATA_DIR", "./data")
     os.makedirs(data_dir, exist_ok=True)
     maybe_download_gpt2_tokenizer_data(tokenizer_type, data_dir)
-    DownloaderClass = DATA_DOWNLOADERS.get(dataset_name.split('/')[0].lower(), None)
+    DownloaderClass = DATA_DOWNLOADERS.get(dataset_name.split("/")[0].lower(), None)
 
     # print(f'check {dataset_name.split('/')[0]}')
     if DownloaderClass is None:
@@ -389,8 +1321,9 @@ def prepare_dataset(
         pass
 
     else:
-        num_workers = 1
-        ds_name  = dataset_name if dataset_name.split('/')[0] in ["customdataset"] else None
+        ds_name = (
+            dataset_name if dataset_name.split("/")[0] in ["customdataset"] else None
+        )
         d = DownloaderClass(
             tokenizer_type=tokenizer_type,
             vocab_file=vocab_file,
@@ -398,6 +1331,10 @@ def prepare_dataset(
             data_dir=data_dir,
             force_redownload=force_redownload,
             num_workers=num_workers,
-            dataset_name = ds_name
+            dataset_name=ds_name,
+            decompress=decompress,
+            prefetch_decompressed=prefetch_decompressed,
+            in_process=in_process,
+            stream=stream,
         )
         d.prepare()
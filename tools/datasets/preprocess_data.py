@@ -241,6 +241,10 @@ def main(input_args=None):
     for key in args.jsonl_keys:
         builders[key].finalize(output_idx_files[key])
 
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
 
 if __name__ == "__main__":
     main()
@@ -20,30 +20,29 @@ A script for processing a dataset such that corresponding labels are also produc
 (for example, finetuning a model to only output the text following some delimiter in the finetuning dataset such as "Answer: "
 rather than generating the entire "Question: ... Answer: " turns of conversation.
 
-To run this script, first edit `tools/datasets/corpora.py` such that the command to call `tools/datasets/preprocess_data.py` is as follows:
+To run this script, first edit `DataDownloader.tokenize()` in `tools/datasets/corpora.py` such that its subprocess
+path calls this script instead of `tools/datasets/preprocess_data.py`, with the extra --mask-before-token argument:
 
 ```
-cmd = f"python tools/datasets/preprocess_data_with_mask.py \
-    --input {jsonl_filepath} \
-    --output-prefix {parent_folder}/{self.name} \
-    --vocab {self.vocab_file} \
-    --dataset-impl mmap \
-    --tokenizer-type {self.tokenizer_type} \
-    --merge-file {self.merge_file} \
-    --append-eod \
-    --mask-before-token X,Y,Z \
-    --workers {self.num_workers} "
-
-if self.num_docs is not None:
-    cmd += f"--num-docs {self.num_docs} "
-
-if self.ftfy:
-    cmd += f"--ftfy "
+subprocess.run(
+    [
+        sys.executable,
+        os.path.join(os.path.dirname(__file__), "preprocess_data_with_mask.py"),
+    ]
+    + argv
+    + ["--mask-before-token", "X,Y,Z"],
+    check=True,
+    env=env,
+)
 ```
 where --mask-before-token must be the (comma-separated) list of tokens produced by encoding your delimiter string.
 Up to and including the first occurrence of this token sequence in a document, all tokens will have their loss mask zeroed out when the label dataset is provided to NeoX.
 
-Then, specify
+Then run `prepare_data.py` with --subprocess (or call `prepare_dataset(..., in_process=False)`), since by default
+documents are tokenized on an in-process pool that only produces the text dataset. --stream always uses that pool,
+so it can't be combined with this script.
+
+Finally, specify
 ```
 "train_data_paths": ["/path/to/dataset/name_text_document"],
 "label_data_paths": ["/path/to/dataset/name_label_document"]